@@ -8,17 +8,26 @@ class FirmwareConfig(object):
     def reboot(self):
         return self.reboot_required
 
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 import firmware_config.cisco as cisco
 import firmware_config.dell as dell
 import firmware_config.ibm as ibm
 
 
-def create(vendor, host, user, password):
+def create(vendor, host, user, password, **kwargs):
     if vendor == "cisco":
-        return cisco.CiscoFirmwareConfig(host, user, password)
+        return cisco.CiscoFirmwareConfig(host, user, password, **kwargs)
     elif vendor == "dell":
-        return dell.DellFirmwareConfig(host, user, password)
+        return dell.DellFirmwareConfig(host, user, password, **kwargs)
     elif vendor == "ibm":
-        return ibm.IBMFirmwareConfig(host, user, password)
+        return ibm.IBMFirmwareConfig(host, user, password, **kwargs)
 
     return None
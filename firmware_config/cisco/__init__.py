@@ -1,54 +1,282 @@
 from lxml import etree
-import urllib2
+import errno
+import httplib
+import socket
+import threading
+import time
+import Queue
 from firmware_config import FirmwareConfig
-
-
-class CiscoFirmwareConfig(FirmwareConfig):
-    def __init__(self, host, user, password):
+from firmware_config import exceptions as exc
+
+# Keep-alive HTTPS connections to each CIMC are shared by every
+# CiscoFirmwareConfig with the same host and pool settings. POOL_SIZE
+# caps the number of connections open to one host at once.
+POOL_SIZE = 2
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+# Bytes of a streamed response to read at a time
+READ_CHUNK = 16384
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+# Seconds a session lasts without a refresh, if the CIMC doesn't say
+DEFAULT_REFRESH_PERIOD = 600
+# The XML API error code for a missing or expired cookie
+AUTH_REQUIRED = "552"
+
+# Classes read by get_fw_options: BIOS tokens and the boot order
+FW_CLASSES = ("biosSettings", "lsbootDef")
+
+BIOS_SETTINGS_DN = "sys/rack-unit-1/bios/bios-settings"
+BOOT_POLICY_DN = "sys/rack-unit-1/boot-policy"
+
+
+def stale_connection(error, sent):
+    # Signs that the CIMC closed an idle keep-alive connection before it
+    # saw the request: the send is refused, or the connection closes
+    # without any status line coming back
+    if not sent:
+        return isinstance(error, socket.error) and \
+            not isinstance(error, socket.timeout) and \
+            error.errno in (errno.EPIPE, errno.ECONNRESET)
+    if isinstance(error, httplib.BadStatusLine):
+        return error.line in ("", "''") or \
+            error.line.startswith("No status line received")
+    return False
+
+
+class ConnectionPool(object):
+    def __init__(self, host, size, connect_timeout, read_timeout):
+        self.host = host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Each slot is either an idle connection or None for one that
+        # hasn't been opened yet. Most recently used connections are
+        # handed out first, so idle ones further down can be left to time
+        # out on the CIMC.
+        self.slots = Queue.LifoQueue()
+        for i in range(size):
+            self.slots.put(None)
+
+    def connect(self):
+        connection = httplib.HTTPSConnection(self.host,
+                                             timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def request(self, body, feed=None):
+        # If feed is given it is passed the body of a successful response
+        # in chunks as they arrive, rather than the whole body being
+        # returned
+        connection = self.slots.get()
+        try:
+            # A reused connection may have been closed by the CIMC while
+            # idle, in which case the request is sent again on a new one.
+            # Anything else, timeouts included, may mean the CIMC has
+            # already acted on the request, so it is never sent twice.
+            reused = connection is not None
+            while True:
+                if connection is None:
+                    connection = self.connect()
+                sent = False
+                try:
+                    connection.request("POST", "/nuova", body,
+                                       {"Content-Type": "text/xml"})
+                    sent = True
+                    response = connection.getresponse()
+                except (httplib.HTTPException, socket.error) as e:
+                    connection.close()
+                    connection = None
+                    if not reused or not stale_connection(e, sent):
+                        raise
+                    reused = False
+                    continue
+                break
+
+            try:
+                if feed is None or response.status != httplib.OK:
+                    data = response.read()
+                else:
+                    data = None
+                    chunk = response.read(READ_CHUNK)
+                    while chunk:
+                        feed(chunk)
+                        chunk = response.read(READ_CHUNK)
+            except Exception:
+                # The rest of the body is still on the way, so the
+                # connection can't be used again
+                connection.close()
+                connection = None
+                raise
+
+            if response.will_close:
+                connection.close()
+                connection = None
+            if response.status != httplib.OK:
+                raise exc.firmware_config_exception(
+                    "HTTP %d %s from %s" % (response.status, response.reason,
+                                            self.host))
+            return data
+        finally:
+            self.slots.put(connection)
+
+
+def get_pool(host, size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT,
+             read_timeout=READ_TIMEOUT):
+    key = (host, size, connect_timeout, read_timeout)
+    with POOLS_LOCK:
+        pool = POOLS.get(key)
+        if pool is None:
+            pool = ConnectionPool(host, size, connect_timeout, read_timeout)
+            POOLS[key] = pool
+    return pool
+
+
+class CiscoSession(object):
+    def __init__(self, pool, user, password):
+        self.pool = pool
+        self.user = user
+        self.password = password
         self.cookie = None
-        super(CiscoFirmwareConfig, self).__init__(host, user, password)
+        self.refresh_at = 0
 
-    def cisco_firmware_request(self, data):
+    def request(self, data, handler=None):
         xmldata = etree.tostring(data)
-        req = urllib2.Request("https://%s/nuova" % self.host, xmldata)
-        response = urllib2.urlopen(req)
-        return etree.fromstring(response.read())
+        if handler is None:
+            return etree.fromstring(self.pool.request(xmldata))
 
-    def cisco_login(self):
+        # Hand each element to the handler as soon as its start tag and
+        # attributes have been parsed, while the rest of the response is
+        # still arriving
+        parser = etree.XMLPullParser(events=("start",))
+
+        def feed(chunk):
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                handler(element)
+
+        self.pool.request(xmldata, feed)
+        return parser.close()
+
+    def started(self, response):
+        self.cookie = response.get("outCookie")
+        if self.cookie is None:
+            return False
+        # Refresh halfway through the period so that a slow request can't
+        # run past the end of it
+        period = int(response.get("outRefreshPeriod",
+                                  DEFAULT_REFRESH_PERIOD))
+        self.refresh_at = time.time() + period / 2
+        return True
+
+    def login(self):
         auth = etree.Element('aaaLogin', inName=self.user,
                              inPassword=self.password)
-        response = self.cisco_firmware_request(auth)
+        response = self.request(auth)
         if response.get("response") != "yes":
             print etree.tostring(response)
             return False
 
-        self.cookie = response.get("outCookie")
-        if self.cookie is None:
+        if not self.started(response):
             print "Unable to get auth cookie"
             return False
 
         return True
 
-    def cisco_logout(self):
+    def refresh(self):
+        auth = etree.Element('aaaRefresh', cookie=self.cookie,
+                             inCookie=self.cookie, inName=self.user,
+                             inPassword=self.password)
+        response = self.request(auth)
+        if response.get("response") != "yes" or not self.started(response):
+            self.cookie = None
+            return False
+        return True
+
+    def get(self):
+        if self.cookie is not None:
+            if time.time() < self.refresh_at or self.refresh():
+                return self.cookie
+        if self.login():
+            return self.cookie
+        return None
+
+    def expired(self):
+        self.cookie = None
+
+    def logout(self):
+        if self.cookie is None:
+            return
         auth = etree.Element('aaaLogout', cookie=self.cookie,
                              inCookie=self.cookie)
-        response = self.cisco_firmware_request(auth)
+        self.request(auth)
+        self.cookie = None
 
-    def get_boot_options(self):
-        bootorder = {}
-        bootdict = dict(default=[], possible=[], new_value=[], pending=[],
-                        current=[], is_list=True)
 
-        if self.cisco_login() is not True:
-            return None
+class CiscoFirmwareConfig(FirmwareConfig):
+    def __init__(self, host, user, password, pool_size=POOL_SIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 stream=False):
+        self.cookie = None
+        self.stream = stream
+        self.pool = get_pool(host, pool_size, connect_timeout, read_timeout)
+        self.session = CiscoSession(self.pool, user, password)
+        super(CiscoFirmwareConfig, self).__init__(host, user, password)
 
-        config = etree.Element('configResolveClass', cookie=self.cookie,
-                               inHierarchical="true", classId="lsbootDef")
+    def cisco_firmware_request(self, data, handler=None):
+        response = self.session.request(data, handler)
+        # The CIMC may have dropped the session, for instance after a
+        # reboot, so log in again and resend the request once
+        if (data.get("cookie") is not None and
+                response.get("errorCode") == AUTH_REQUIRED):
+            self.session.expired()
+            if self.cisco_login():
+                data.set("cookie", self.cookie)
+                response = self.session.request(data, handler)
+        return response
 
-        settings = self.cisco_firmware_request(config)
+    def cisco_login(self):
+        # Reuses the current session if there is one
+        self.cookie = self.session.get()
+        return self.cookie is not None
+
+    def cisco_logout(self):
+        self.session.logout()
+        self.cookie = None
 
+    def close(self):
         self.cisco_logout()
 
+    def cisco_resolve_classes(self, classes, handler=None):
+        # Fetch every class in one configResolveClasses round trip, falling
+        # back to a configResolveClass per class on CIMC firmware that
+        # doesn't support it
+        config = etree.Element('configResolveClasses', cookie=self.cookie,
+                               inHierarchical="true")
+        inids = etree.SubElement(config, 'inIds')
+        for classid in classes:
+            etree.SubElement(inids, 'Id', value=classid)
+
+        response = self.cisco_firmware_request(config, handler)
+        if (response.get("response") == "yes" and
+                response.get("errorCode") is None):
+            return response
+
+        outconfigs = etree.Element('outConfigs')
+        for classid in classes:
+            config = etree.Element('configResolveClass', cookie=self.cookie,
+                                   inHierarchical="true", classId=classid)
+            response = self.cisco_firmware_request(config, handler)
+            for found in response.iter(classid):
+                outconfigs.append(found)
+        return outconfigs
+
+    def parse_boot_options(self, settings):
+        bootorder = {}
+        bootdict = dict(default=[], possible=[], new_value=[], pending=[],
+                        current=[], is_list=True)
+
         settings = settings.find('.//lsbootDef')
         for boot in settings:
             order = boot.get("order")
@@ -69,59 +297,80 @@ class CiscoFirmwareConfig(FirmwareConfig):
 
         return bootdict
 
+    def parse_bios_setting(self, child, options):
+        tag = child.tag
+        cisco_rn = child.get("rn")
+        for attribute in child.keys():
+            if attribute == "rn":
+                continue
+            options[attribute[2:]] = dict(current=child.get(attribute),
+                                          default=None, possible=None,
+                                          new_value=None, pending=None,
+                                          cisco_rn=cisco_rn,
+                                          cisco_tag=tag, is_list=False)
+
+    def parse_bios_options(self, settings, options):
+        for setting in settings.iter("biosSettings"):
+            for child in setting.iter():
+                self.parse_bios_setting(child, options)
+
+    def stream_bios_options(self, element, options):
+        if element.tag != "biosSettings":
+            if next(element.iterancestors("biosSettings"), None) is None:
+                return
+        self.parse_bios_setting(element, options)
+
+        # Anything before this token has been fully parsed and recorded,
+        # so it can be dropped from the tree
+        if element.tag != "biosSettings":
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+
+    def get_boot_options(self):
+        if self.cisco_login() is not True:
+            return None
+
+        config = etree.Element('configResolveClass', cookie=self.cookie,
+                               inHierarchical="true", classId="lsbootDef")
+
+        settings = self.cisco_firmware_request(config)
+
+        return self.parse_boot_options(settings)
+
     def factory_reset(self):
         options = self.get_fw_options()
         for option in options:
             options[option]['new_value'] = "platform-default"
         self.set_fw_options(options)
 
-    def get_fw_options(self):
+    def get_fw_options(self, classes=FW_CLASSES):
         options = {}
 
         if self.cisco_login() is not True:
             print "Failed to login"
             return
 
-        config = etree.Element('configResolveClass', cookie=self.cookie,
-                               inHierarchical="true", classId="biosSettings")
-
-        settings = self.cisco_firmware_request(config)
+        handler = None
+        if self.stream and "biosSettings" in classes:
+            handler = lambda element: self.stream_bios_options(element,
+                                                               options)
 
-        for setting in settings.iter("biosSettings"):
-            for child in setting.iter():
-                tag = child.tag
-                cisco_rn = child.get("rn")
-                for attribute in child.keys():
-                    if attribute == "rn":
-                        continue
-                    options[attribute[2:]] = dict(current=child.get(attribute),
-                                                  default=None, possible=None,
-                                                  new_value=None, pending=None,
-                                                  cisco_rn=cisco_rn,
-                                                  cisco_tag=tag, is_list=False)
+        settings = self.cisco_resolve_classes(classes, handler)
 
-        self.cisco_logout()
+        if "biosSettings" in classes and handler is None:
+            self.parse_bios_options(settings, options)
 
-        options['boot_order'] = self.get_boot_options()
+        if "lsbootDef" in classes:
+            options['boot_order'] = self.parse_boot_options(settings)
 
         return options
 
-    def set_boot_options(self, options):
+    def boot_policy(self, options):
         order = 1
 
-        if options == "platform-default":
-            return
-
-        self.cisco_login()
-        config = etree.Element('configConfMo',
-                               dn='sys/rack-unit-1/boot-policy',
-                               inHierarchical='true', cookie=self.cookie)
-        inconfig = etree.Element('inConfig')
-        lsbootdef = etree.Element('lsbootDef',
-                                  dn="sys/rack-unit-1/boot-policy",
+        lsbootdef = etree.Element('lsbootDef', dn=BOOT_POLICY_DN,
                                   rebootOnUpdate="no")
-        config.append(inconfig)
-        inconfig.append(lsbootdef)
 
         for option in options:
             if option == "lan":
@@ -153,20 +402,50 @@ class CiscoFirmwareConfig(FirmwareConfig):
                 lsbootdef.append(efi)
             order += 1
 
+        return lsbootdef
+
+    def cisco_conf_mo(self, dn, mo):
+        config = etree.Element('configConfMo', dn=dn, inHierarchical='true',
+                               cookie=self.cookie)
+        inconfig = etree.SubElement(config, 'inConfig')
+        inconfig.append(mo)
         response = self.cisco_firmware_request(config)
-        self.cisco_logout()
+        return response.get("response") == "yes"
+
+    def cisco_conf_mos(self, mos):
+        # Write all of the managed objects in a single configConfMos
+        # transaction, or one configConfMo each on CIMC firmware that
+        # doesn't support it
+        if len(mos) > 1:
+            config = etree.Element('configConfMos', inHierarchical='true',
+                                   cookie=self.cookie)
+            inconfigs = etree.SubElement(config, 'inConfigs')
+            for dn, mo in mos:
+                pair = etree.SubElement(inconfigs, 'pair', key=dn)
+                pair.append(mo)
+            response = self.cisco_firmware_request(config)
+            if (response.get("response") == "yes" and
+                    response.get("errorCode") is None):
+                return True
+
+        result = True
+        for dn, mo in mos:
+            if not self.cisco_conf_mo(dn, mo):
+                result = False
+        return result
+
+    def set_boot_options(self, options):
+        if options == "platform-default":
+            return
+
+        self.cisco_login()
+        self.cisco_conf_mo(BOOT_POLICY_DN, self.boot_policy(options))
 
     def set_fw_options(self, options):
         changes = False
+        bootpolicy = None
 
-        config = etree.Element('configConfMo',
-                               dn='sys/rack-unit-1/bios/bios-settings',
-                               inHierarchical='true')
-        inconfig = etree.Element('inConfig')
-        biossettings = etree.Element('biosSettings')
-
-        config.append(inconfig)
-        inconfig.append(biossettings)
+        biossettings = etree.Element('biosSettings', dn=BIOS_SETTINGS_DN)
 
         for option in options.keys():
             if options[option]['new_value'] is None:
@@ -177,31 +456,33 @@ class CiscoFirmwareConfig(FirmwareConfig):
                 continue
 
             if option == "boot_order":
-                self.set_boot_options(options[option]['new_value'])
+                if options[option]['new_value'] != "platform-default":
+                    bootpolicy = self.boot_policy(options[option]['new_value'])
                 self.reboot_required = True
                 continue
 
             changes = True
             setting = etree.Element(options[option]['cisco_tag'],
-                                    dn="sys/rack-unit-1/bios/bios-settings/%s"
-                                    % options[option]['cisco_rn'])
+                                    dn="%s/%s" % (BIOS_SETTINGS_DN,
+                                                  options[option]['cisco_rn']))
             setting.set("vp%s" % option, options[option]['new_value'])
             biossettings.append(setting)
 
             options[option]['pending'] = options[option]['new_value']
 
-        if not changes:
+        # The BIOS tokens and the boot policy go to the CIMC together
+        mos = []
+        if changes:
+            mos.append((BIOS_SETTINGS_DN, biossettings))
+        if bootpolicy is not None:
+            mos.append((BOOT_POLICY_DN, bootpolicy))
+
+        if not mos:
             return
 
         self.cisco_login()
 
-        config.set('cookie', self.cookie)
-
-        response = self.cisco_firmware_request(config)
-
-        self.cisco_logout()
-
-        if response.get("response") != "yes":
+        if not self.cisco_conf_mos(mos):
             return False
 
         self.reboot_required = True
@@ -222,8 +503,6 @@ class CiscoFirmwareConfig(FirmwareConfig):
 
         response = self.cisco_firmware_request(config)
 
-        self.cisco_logout()
-
         if response.get("response") != "yes":
             return False
 
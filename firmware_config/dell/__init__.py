@@ -1,6 +1,47 @@
 import pywsman
+import fnmatch
+import os
 import time
+import threading
+import Queue
+from lxml import etree
+from xml.sax.saxutils import escape
 from firmware_config import FirmwareConfig
+from firmware_config import exceptions as exc
+from firmware_config import retry
+
+# Instances to ask the iDRAC for with the enumerate response and with each
+# pull, rather than one per pull
+MAX_ELEMENTS = 50
+
+# Enumerations run at once against one iDRAC, across every
+# DellFirmwareConfig for that host. The first instance for a host sets the
+# limit for all of them.
+CONCURRENCY = 2
+HOST_LIMITS = {}
+HOST_LIMITS_LOCK = threading.Lock()
+
+# The attribute schemas read by get_fw_options, in the order their
+# options are merged
+FW_SCHEMAS = ["BIOS", "LC", "iDRACCard", "NIC"]
+
+LIFECYCLE_JOB_SCHEMA = "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/root/dcim/DCIM_LifecycleJob"
+# Job states that won't change any further
+JOB_FINISHED = frozenset(["Completed", "Completed with Errors", "Failed",
+                          "Reboot Completed", "Reboot Failed"])
+# Seconds between job polls, growing from JOB_POLL_INITIAL while the jobs
+# are running, and how long to wait for them in total
+JOB_POLL_INITIAL = 5
+JOB_POLL_MAXIMUM = 30
+JOB_TIMEOUT = 3600
+
+LC_SERVICE_SCHEMA = "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/root/dcim/DCIM_LCService"
+# Server Configuration Profile components by FQDD prefix, and the FQDD to
+# write options without one of their own to
+SCP_SCHEMAS = [("BIOS.", "BIOS"), ("NIC.", "NIC"), ("iDRAC.", "iDRACCard"),
+               ("LifecycleController.", "LC")]
+SCP_FQDDS = {"BIOS": "BIOS.Setup.1-1", "iDRACCard": "iDRAC.Embedded.1",
+             "LC": "LifecycleController.Embedded.1"}
 
 
 def generate_dell_selectors(name):
@@ -23,6 +64,176 @@ def set_power_selectors(client_options):
     return client_options
 
 
+def get_host_limit(host, concurrency):
+    with HOST_LIMITS_LOCK:
+        limit = HOST_LIMITS.get(host)
+        if limit is None:
+            limit = threading.BoundedSemaphore(max(concurrency, 1))
+            HOST_LIMITS[host] = limit
+    return limit
+
+
+def poll_jobs(jobs, timeout=JOB_TIMEOUT):
+    # jobs maps each DellFirmwareConfig to the InstanceIDs of the jobs to
+    # wait for on its host, so that jobs on many hosts share one loop.
+    # Returns the same mapping with a status dict for each job.
+    started = time.time()
+    results = {}
+    pending = []
+    for config in jobs:
+        results[config] = {}
+        for jobid in jobs[config]:
+            results[config][jobid] = dict(status=None, percent=None,
+                                          message=None, finished=False,
+                                          polls=0, started=started,
+                                          finished_at=None, elapsed=None)
+            pending.append((config, jobid))
+
+    policy = retry.RetryPolicy(initial=JOB_POLL_INITIAL, multiplier=1.5,
+                               maximum=JOB_POLL_MAXIMUM, deadline=timeout)
+    for attempt in policy.attempts():
+        for (config, jobid) in list(pending):
+            job = results[config][jobid]
+            config.get_job_status(jobid, job)
+            if job['finished']:
+                pending.remove((config, jobid))
+        if not pending:
+            break
+
+    return results
+
+
+def dell_selector(name):
+    # Works out which schema an option name, a group such as
+    # BIOS.ProcSettings.* or a NIC FQDD belongs to, along with a WQL
+    # condition matching it. The condition is None if the whole schema
+    # has to be read.
+    if name.startswith("NIC.") and not name.startswith("NIC.NIC."):
+        # A pattern such as NIC.* or NIC.Integrated.* can't be written as
+        # an FQDD comparison
+        if "*" in name:
+            return ("NIC", None)
+        return ("NIC", "FQDD = '%s'" % name)
+
+    parts = name.split(".")
+    schema = parts[0]
+    rest = parts[1:]
+    if not rest or rest == ["*"]:
+        return (schema, None)
+
+    if rest[-1] == "*":
+        prefix = ".".join(rest[:-1])
+        attribute = None
+    elif schema == "NIC" and "-" in rest[-1]:
+        # NIC FQDDs end in port numbers such as 1-1-1, which attribute
+        # names never contain
+        prefix = ".".join(rest)
+        attribute = None
+    else:
+        prefix = ".".join(rest[:-1])
+        attribute = rest[-1]
+
+    if "*" in prefix or (attribute is not None and "*" in attribute):
+        return (schema, None)
+
+    conditions = []
+    if prefix:
+        if schema == "NIC":
+            conditions.append("FQDD = '%s'" % prefix)
+        else:
+            conditions.append("GroupID = '%s'" % prefix)
+    if attribute is not None:
+        conditions.append("AttributeName = '%s'" % attribute)
+    return (schema, " and ".join(conditions))
+
+
+def dell_selected(option, values, names):
+    for name in names:
+        if fnmatch.fnmatchcase(option, name):
+            return True
+        if option.startswith(name + ".") or values['dell_fqdd'] == name:
+            return True
+        if values['dell_fqdd'] is not None and \
+           fnmatch.fnmatchcase(values['dell_fqdd'], name):
+            return True
+    return False
+
+
+def get_job_id(result):
+    status = result.root().find(None, "ReturnValue").__str__()
+
+    if status == '0' or status == '4096':
+        selector = result.root().find(None, "Selector")
+        while selector:
+            attr = selector.attr_find(None, 'Name')
+            if attr.value() == 'InstanceID':
+                return selector.__str__()
+            selector = selector.next()
+
+    return None
+
+
+def scp_to_options(xml):
+    # Attributes the iDRAC won't let us change are exported commented out,
+    # so only settable ones are returned. The profile doesn't say which
+    # group BIOS attributes are in, so they are named BIOS.<attribute>.
+    options = {}
+    root = etree.fromstring(xml)
+    for component in root.iter("Component"):
+        fqdd = component.get("FQDD")
+        name = None
+        for (prefix, schema) in SCP_SCHEMAS:
+            if fqdd.startswith(prefix):
+                name = schema
+        if name is None:
+            continue
+
+        for attribute in component.findall("Attribute"):
+            dell_name = attribute.get("Name")
+            if name == "NIC":
+                option_name = "%s.%s.%s" % (name, fqdd, dell_name)
+            else:
+                option_name = "%s.%s" % (name, dell_name.replace("#", "."))
+            options[option_name] = dict(current=attribute.text or "",
+                                        default=None,
+                                        possible=[],
+                                        pending=None,
+                                        is_list=False,
+                                        dell_boot=False,
+                                        dell_schema=name,
+                                        dell_name=dell_name,
+                                        new_value=None,
+                                        dell_fqdd=fqdd)
+    return options
+
+
+def options_to_scp(options):
+    components = {}
+    root = etree.Element("SystemConfiguration")
+    for option in sorted(options.keys()):
+        if options[option]['dell_boot']:
+            continue
+        if options[option]['new_value'] is None:
+            continue
+        if options[option]['current'] == options[option]['new_value']:
+            continue
+
+        fqdd = options[option]['dell_fqdd']
+        if fqdd is None:
+            fqdd = SCP_FQDDS.get(options[option]['dell_schema'])
+        component = components.get(fqdd)
+        if component is None:
+            component = etree.SubElement(root, "Component", FQDD=fqdd)
+            components[fqdd] = component
+        attribute = etree.SubElement(component, "Attribute",
+                                     Name=options[option]['dell_name'])
+        attribute.text = options[option]['new_value']
+
+    if not components:
+        return None
+    return etree.tostring(root)
+
+
 def generate_xml(method, schema, content):
     xml = '''<p:%s_INPUT xmlns:p="%s">''' % (method, schema)
     xml += content
@@ -32,30 +243,27 @@ def generate_xml(method, schema, content):
 
 
 class DellFirmwareConfig(FirmwareConfig):
-    def __init__(self, host, user, password):
+    def __init__(self, host, user, password, max_elements=MAX_ELEMENTS,
+                 concurrency=CONCURRENCY, scp_share=None, scp_path=None):
+        self.client = None
+        self.scp_share = scp_share
+        self.scp_path = scp_path
+        # Profile imports waiting for the next reboot, with their files
+        self.scp_jobs = []
+        self.spare_clients = []
+        self.max_elements = max_elements
+        self.concurrency = concurrency
+        self.limit = get_host_limit(host, concurrency)
         super(DellFirmwareConfig, self).__init__(host, user, password)
 
-    def get_boot_options(self):
+    def get_boot_options(self, client=None):
         options = {}
-        client = self.get_dell_client()
         schema = "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/root/dcim/DCIM_BootSourceSetting"
-        client_options = pywsman.ClientOptions()
-
-        #client_options.set_cim_namespace("root/dcim")
-        boot_options = client.enumerate(client_options, None, schema)
-
-        if boot_options is None:
-            return options
-
-        context = boot_options.context()
 
-        while context:
+        for boot_option in self.dell_enumerate(schema,
+                                               "DCIM_BootSourceSetting",
+                                               client):
             try:
-                boot_option = client.pull(client_options, None, schema,
-                                          context.__str__())
-                context = boot_option.context()
-                boot_option = boot_option.root().find(None,
-                                                      "DCIM_BootSourceSetting")
                 boot_type = boot_option.find(None, "BootSourceType").__str__()
                 label = boot_option.find(None, "BootString").__str__()
                 enabled = boot_option.find(None, "CurrentEnabledStatus").__str__()
@@ -80,7 +288,7 @@ class DellFirmwareConfig(FirmwareConfig):
                 options[name]['dell_schema'] = 'BIOS'
                 options[name]['dell_fqdd'] = 'BIOS.Setup.1-1'
             except AttributeError:
-                break
+                continue
 
         for name in options.keys():
             for i in range(len(options[name]['dell_pending'])):
@@ -89,28 +297,14 @@ class DellFirmwareConfig(FirmwareConfig):
                     options[name]['pending'].append(label)
         return options
 
-    def get_options(self, name):
+    def get_options(self, name, client=None, query=None):
         schema = "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/root/dcim/DCIM_%sEnumeration" % name
         tag = "DCIM_%sEnumeration" % name
         options = {}
 
-        client = self.get_dell_client()
-
-        client_options = pywsman.ClientOptions()
-
-        firmware_options = client.enumerate(client_options, None, schema)
-
-        if firmware_options is None:
-            return options
-
-        context = firmware_options.context()
-
-        while context:
+        for firmware_option in self.dell_enumerate(schema, tag, client,
+                                                   query):
             try:
-                firmware_option = client.pull(client_options, None, schema,
-                                              context.__str__())
-                context = firmware_option.context()
-                firmware_option = firmware_option.root().find(None, tag)
                 attribute_name = firmware_option.find(None, "AttributeName").__str__()
                 current_value = firmware_option.find(None, "CurrentValue").__str__()
                 pending_value = firmware_option.find(None, "PendingValue").__str__()
@@ -157,47 +351,179 @@ class DellFirmwareConfig(FirmwareConfig):
 
         return options
 
-    def get_fw_options(self):
-        host_options = self.get_options("BIOS")
-        lc_options = self.get_options("LC")
-        idrac_options = self.get_options("iDRACCard")
-        nic_options = self.get_options("NIC")
-        boot_options = self.get_boot_options()
-
-        # Merge with the boot options
-        options = dict(host_options.items() + lc_options.items() +
-                       idrac_options.items() + nic_options.items() +
-                       boot_options.items())
+    def dell_enumerate(self, schema, tag, client=None, query=None):
+        if client is None:
+            client = self.get_dell_client()
+        client_options = pywsman.ClientOptions()
+        if self.max_elements:
+            client_options.set_flags(pywsman.FLAG_ENUMERATION_OPTIMIZATION)
+            client_options.set_max_elements(self.max_elements)
+
+        if query is None:
+            result = client.enumerate(client_options, None, schema)
+        else:
+            query_filter = pywsman.Filter()
+            query_filter.wql(query)
+            result = client.enumerate(client_options, query_filter, schema)
+            if result is None or result.is_fault():
+                raise exc.UnsupportedException(
+                    "%s does not support WQL filters" % self.host)
+
+        # Yield every instance in the enumerate response and each pull
+        # response until the iDRAC stops handing back a context
+        while result is not None:
+            items = result.root().find(None, "Items")
+            if items is not None:
+                item = items.child()
+                while item is not None:
+                    if item.name() == tag:
+                        yield item
+                    item = item.next()
+
+            context = result.context()
+            if not context:
+                break
+            result = client.pull(client_options, None, schema,
+                                 context.__str__())
+
+    def get_fw_options_worker(self, requests, results):
+        # A pywsman client only runs one request at a time, so each worker
+        # needs its own. Clients are kept for the next call rather than
+        # connecting again.
+        try:
+            client = self.spare_clients.pop()
+        except IndexError:
+            client = self.new_dell_client()
+
+        try:
+            while True:
+                try:
+                    name = requests.get_nowait()
+                except Queue.Empty:
+                    return
+
+                with self.limit:
+                    try:
+                        if name is None:
+                            result = self.get_boot_options(client)
+                        else:
+                            result = self.get_options(name, client)
+                    except Exception as e:
+                        result = e
+                results[name] = result
+        finally:
+            self.spare_clients.append(client)
+
+    def get_selected_options(self, names):
+        boot = False
+        conditions = {}
+        for name in names:
+            if name.startswith("BootOrder"):
+                boot = True
+                continue
+            (schema, condition) = dell_selector(name)
+            if schema not in FW_SCHEMAS:
+                continue
+            if condition is None:
+                conditions[schema] = None
+            elif conditions.get(schema, []) is not None:
+                conditions.setdefault(schema, []).append(condition)
+
+        options = {}
+        for schema in FW_SCHEMAS:
+            if schema not in conditions:
+                continue
+            if conditions[schema] is None:
+                options.update(self.get_options(schema))
+                continue
+
+            query = "select * from DCIM_%sEnumeration where %s" % \
+                    (schema, " or ".join("(%s)" % condition
+                                         for condition in conditions[schema]))
+            try:
+                options.update(self.get_options(schema, query=query))
+            except exc.UnsupportedException:
+                options.update(self.get_options(schema))
+
+        if boot:
+            options.update(self.get_boot_options())
+
+        # Drop anything that came back without being asked for, such as the
+        # rest of a schema that had to be read in full
+        for option in options.keys():
+            if not dell_selected(option, options[option], names):
+                del options[option]
         return options
 
-    def wait_for_jobs(self, jobs):
+    def get_fw_options(self, names=None, scp=False):
+        if scp:
+            options = self.get_scp_options()
+            if names is not None:
+                for option in options.keys():
+                    if not dell_selected(option, options[option], names):
+                        del options[option]
+            return options
+
+        # Just the options matching names, if given, rather than all of them
+        if names is not None:
+            return self.get_selected_options(names)
+
+        # None stands for the boot options
+        names = FW_SCHEMAS + [None]
+        requests = Queue.Queue()
+        for name in names:
+            requests.put(name)
+
+        results = {}
+        workers = []
+        try:
+            for i in range(min(max(self.concurrency, 1), len(names))):
+                worker = threading.Thread(target=self.get_fw_options_worker,
+                                          args=(requests, results))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+        finally:
+            for worker in workers:
+                worker.join()
+
+        options = {}
+        for name in names:
+            if isinstance(results[name], Exception):
+                raise results[name]
+            options.update(results[name])
+        return options
+
+    def get_job_status(self, jobid, job):
+        # Ask for the one job rather than enumerating the whole job queue
         client = self.get_dell_client()
-        schema = "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/root/dcim/DCIM_LifecycleJob"
         client_options = pywsman.ClientOptions()
-        pending = False
+        client_options.add_selector("InstanceID", jobid)
 
-        while jobs:
-            joblist = client.enumerate(client_options, None, schema)
+        job['polls'] += 1
+        result = client.get(client_options, LIFECYCLE_JOB_SCHEMA)
+        if result is None:
+            return
 
-            context = joblist.context()
+        status = result.root().find(None, "JobStatus")
+        if status is None:
+            return
 
-            while not context:
-                os.sleep(30)
-                context = joblist.context()
+        job['status'] = status.__str__()
+        percent = result.root().find(None, "PercentComplete")
+        if percent is not None:
+            job['percent'] = percent.__str__()
+        message = result.root().find(None, "Message")
+        if message is not None:
+            job['message'] = message.__str__()
 
-            while context:
-                job = client.pull(client_options, None, schema,
-                                  context.__str__())
-                context = job.context()
-                jobid = job.root().find(None, "InstanceID").__str__()
-                complete = job.root().find(None, "PercentComplete").__str__()
-                if jobid not in jobs:
-                    continue
+        if job['percent'] == "100" or job['status'] in JOB_FINISHED:
+            job['finished'] = True
+            job['finished_at'] = time.time()
+            job['elapsed'] = job['finished_at'] - job['started']
 
-                if complete == "100":
-                    jobs.remove(jobid)
-            if jobs:
-                time.sleep(30)
+    def wait_for_jobs(self, jobs, timeout=JOB_TIMEOUT):
+        return poll_jobs({self: jobs}, timeout)[self]
 
     def set_nic_options(self, options):
         NICs = []
@@ -384,7 +710,109 @@ class DellFirmwareConfig(FirmwareConfig):
             client_options.set_cim_namespace("root/dcim")
             result = client.invoke(client_options, schema, method, wsxml)
 
-    def set_fw_options(self, options):
+    def scp_invoke(self, method, filename, params):
+        client = self.get_dell_client()
+        client_options = pywsman.ClientOptions()
+        selectors = generate_dell_selectors("LC")
+        set_dell_selectors(client_options, selectors)
+
+        params = dict(params)
+        params.update(self.scp_share)
+        params["FileName"] = filename
+        xml = ""
+        for param in sorted(params):
+            # Share credentials can contain anything, & and < included
+            xml += "<p:%s>%s</p:%s>" % (param, escape("%s" % params[param]),
+                                        param)
+        xml = generate_xml(method, LC_SERVICE_SCHEMA, xml)
+
+        wsxml = pywsman.create_doc_from_string(xml)
+        result = client.invoke(client_options, LC_SERVICE_SCHEMA, method,
+                               wsxml)
+        if result is None:
+            return None
+
+        return get_job_id(result)
+
+    def scp_file(self):
+        if self.scp_share is None or self.scp_path is None:
+            raise exc.UnsupportedException(
+                "No share configured for configuration profiles")
+
+        filename = "firmware_config-%s-%d.xml" % (self.host,
+                                                  int(time.time() * 1000))
+        return (filename, os.path.join(self.scp_path, filename))
+
+    def get_scp_options(self):
+        # Have the iDRAC write its whole configuration out to the share in
+        # one job, rather than enumerating every attribute
+        (filename, path) = self.scp_file()
+        job = self.scp_invoke("ExportSystemConfiguration", filename,
+                              dict(Target="BIOS,NIC,IDRAC,LifecycleController"))
+        if job is None:
+            raise exc.TransferException(
+                "Unable to start a configuration export on %s" % self.host)
+
+        status = self.wait_for_jobs([job])[job]
+        if status['status'] != "Completed":
+            raise exc.TransferException(
+                "Configuration export %s on %s: %s: %s" %
+                (job, self.host, status['status'], status['message']))
+
+        try:
+            with open(path) as f:
+                return scp_to_options(f.read())
+        finally:
+            os.unlink(path)
+
+    def set_scp_options(self, options):
+        # Every changed attribute goes to the iDRAC in one profile import.
+        # The import never reboots the system itself: BIOS and NIC changes
+        # wait for reboot_system, while iDRAC and LC ones are applied
+        # straight away. Boot order changes aren't part of the profile and
+        # are still made through the BIOS service.
+        ret = True
+
+        xml = options_to_scp(options)
+        if xml is not None:
+            reboot = False
+            for option in options:
+                if options[option]['dell_boot']:
+                    continue
+                if options[option]['new_value'] is None:
+                    continue
+                if options[option]['current'] == options[option]['new_value']:
+                    continue
+                if options[option]['dell_schema'] in ("BIOS", "NIC"):
+                    reboot = True
+
+            (filename, path) = self.scp_file()
+            with open(path, "w") as f:
+                f.write(xml)
+            job = self.scp_invoke("ImportSystemConfiguration", filename,
+                                  dict(ShutdownType="2"))
+            if job is None:
+                os.unlink(path)
+                ret = False
+            elif reboot:
+                # The iDRAC reads the profile again when the job runs
+                self.scp_jobs.append((job, path))
+                self.reboot_required = True
+            else:
+                status = self.wait_for_jobs([job])[job]
+                os.unlink(path)
+                if status['status'] != "Completed":
+                    ret = False
+
+        if self.set_boot_options(options) == False:
+            ret = False
+
+        return ret
+
+    def set_fw_options(self, options, scp=False):
+        if scp:
+            return self.set_scp_options(options)
+
         ret = True
 
         if self.set_options(options, "BIOS", "BIOS.Setup.1-1") == False:
@@ -463,17 +891,7 @@ class DellFirmwareConfig(FirmwareConfig):
         if result is None:
             return None
 
-        status = result.root().find(None, "ReturnValue").__str__()
-
-        if status == '0' or status == '4096':
-            selector = result.root().find(None, "Selector")
-            while selector:
-                attr = selector.attr_find(None, 'Name')
-                if attr.value() == 'InstanceID':
-                    return selector.__str__()
-                selector = selector.next()
-
-        return None
+        return get_job_id(result)
 
     def apply_settings(self, options):
         fqdds = {}
@@ -507,13 +925,46 @@ class DellFirmwareConfig(FirmwareConfig):
         return success
 
     def reboot_system(self, options):
-        if self.apply_settings(options) == False:
+        if not self.scp_jobs:
+            if self.apply_settings(options) == False:
+                self.force_reboot()
+            return
+
+        # Profile imports from set_fw_options(scp=True) run on this reboot
+        # without config jobs of their own. Only a boot order change needs
+        # one, and that job reboots the system; otherwise reboot it here.
+        boot = {}
+        if options is not None:
+            for option in options:
+                if options[option]['dell_boot'] and \
+                   (options[option]['new_value'] or options[option]['pending']):
+                    boot[option] = options[option]
+        if not boot or self.apply_settings(boot) == False:
             self.force_reboot()
 
-    def get_dell_client(self):
+        jobs = self.scp_jobs
+        self.scp_jobs = []
+        self.wait_for_jobs([job for (job, path) in jobs])
+        for (job, path) in jobs:
+            os.unlink(path)
+
+    def new_dell_client(self):
         client = pywsman.Client("https://%s:%s@%s:443/wsman" % (self.user, self.password, self.host))
 
         client.transport().set_verify_host(0)
         client.transport().set_verify_peer(0)
 
         return client
+
+    def get_dell_client(self):
+        # The client holds on to its connection to the iDRAC between
+        # requests, so keep using the same one rather than connecting and
+        # authenticating again for every call
+        if self.client is None:
+            self.client = self.new_dell_client()
+        return self.client
+
+    def close(self):
+        # Dropping the clients closes their connections
+        self.client = None
+        self.spare_clients = []
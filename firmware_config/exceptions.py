@@ -4,3 +4,14 @@ class firmware_config_exception(Exception):
 
 class AuthException(firmware_config_exception):
     pass
+
+
+class TransferException(firmware_config_exception):
+    def __init__(self, message, retryable=True, resumable=True):
+        super(TransferException, self).__init__(message)
+        self.retryable = retryable
+        self.resumable = resumable
+
+
+class UnsupportedException(firmware_config_exception):
+    pass
@@ -1,40 +1,91 @@
 # -*- coding: utf-8 -*-
+import struct
 
-class BitArray:
+class NeedMoreData(Exception):
+	pass
 
-	def __init__(self, data):
+class BitReader(object):
+
+	def __init__(self, data, offset=0, final=True):
+		# data may be a str, bytearray or anything else struct can unpack
+		# from, and is never copied. If final is False more data is
+		# expected to arrive through extend().
 		self._Data = data
-		
-		self._DataBitsLeft = len(data) * 8
+		self._DataLen = len(data)
+		self._ByteIdx = offset
+		self.final = final
 
-		self._ByteIdx = 0
-		self._BitIdx = 0
-	
-	def mask(self, bitcount):
-		return (1 << bitcount) - 1
+		# Bits that have been loaded from the buffer but not yet consumed,
+		# kept right-aligned in _Acc
+		self._Acc = 0
+		self._AccBits = 0
 
-	def read(self, bitsleftcount):
-
-		result = 0
-		bitsdonecount = 0
-		while bitsleftcount:
-			curbitsleftcount = 8 - self._BitIdx
-			curdata = ord(self._Data[self._ByteIdx]) & self.mask(curbitsleftcount)
-			
-			if curbitsleftcount >= bitsleftcount:
-				result <<= bitsleftcount				
-				result |= curdata >> (curbitsleftcount - bitsleftcount)
-				self._BitIdx += bitsleftcount
-				bitsleftcount = 0
+	def _refill(self, bitcount):
+		while self._AccBits < bitcount:
+			if self._ByteIdx + 4 <= self._DataLen:
+				word = struct.unpack_from(">I", self._Data, self._ByteIdx)[0]
+				self._Acc = (self._Acc << 32) | word
+				self._AccBits += 32
+				self._ByteIdx += 4
 			else:
-				result <<= curbitsleftcount
-				result |= curdata
-				bitsleftcount -= curbitsleftcount
-				self._BitIdx += curbitsleftcount
-			
-			if self._BitIdx >= 8:
-				self._BitIdx = 0
+				# Bits past the end of the buffer read as zero, so that
+				# table lookups near the end of the stream can look
+				# further ahead than the final code actually needs
+				if self._ByteIdx < self._DataLen:
+					byte = struct.unpack_from(">B", self._Data, self._ByteIdx)[0]
+				elif self.final:
+					byte = 0
+				else:
+					raise NeedMoreData
+				self._Acc = (self._Acc << 8) | byte
+				self._AccBits += 8
 				self._ByteIdx += 1
-				
+
+	def extend(self, data, final=False):
+		# Drop the bytes that have already been loaded into the
+		# accumulator before appending, so the buffer only ever holds
+		# the unread tail of the stream
+		if isinstance(self._Data, bytearray):
+			del self._Data[:self._ByteIdx]
+		else:
+			self._Data = bytearray(self._Data[self._ByteIdx:])
+		self._Data += data
+		self._DataLen = len(self._Data)
+		self._ByteIdx = 0
+		self.final = final
+
+	def available(self):
+		return (self._DataLen - self._ByteIdx) * 8 + self._AccBits
+
+	def save(self):
+		return (self._ByteIdx, self._Acc, self._AccBits)
+
+	def restore(self, state):
+		(self._ByteIdx, self._Acc, self._AccBits) = state
+
+	def peek(self, bitcount):
+		if self._AccBits < bitcount:
+			self._refill(bitcount)
+		return (self._Acc >> (self._AccBits - bitcount)) & ((1 << bitcount) - 1)
+
+	def skip(self, bitcount):
+		if self._AccBits < bitcount:
+			self._refill(bitcount)
+		self._AccBits -= bitcount
+		self._Acc &= (1 << self._AccBits) - 1
+
+	def read(self, bitcount):
+		if self._AccBits < bitcount:
+			self._refill(bitcount)
+		self._AccBits -= bitcount
+		result = self._Acc >> self._AccBits
+		self._Acc &= (1 << self._AccBits) - 1
 		return result
 
+class BitArray(BitReader):
+
+	def __init__(self, data):
+		super(BitArray, self).__init__(data)
+
+	def mask(self, bitcount):
+		return (1 << bitcount) - 1
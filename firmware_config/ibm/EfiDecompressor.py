@@ -4,6 +4,14 @@ import os
 import sys
 import BitArray
 
+# Number of bits resolved by the primary lookup table. Longer codes are
+# resolved through a secondary table hanging off the primary entry.
+HUFFMAN_TABLE_BITS = 9
+
+# Longest back-reference a single charlen symbol can produce, and how far
+# back it can point (the Tiano format uses a 19 bit window)
+MAX_MATCH = 0xff + 3
+WINDOW_SIZE = 1 << 19
 
 def LoadHuffmanSyms(bits, symscountbits, zeroskipidx):
 	huffsyms = None
@@ -70,7 +78,59 @@ def HuffmanDecode(hufftree, bits):
 
 
 
-def LoadCharLenHuffmanSyms(bits, extra_hufftree):
+def BuildHuffmanTable(huffsyms, tablebits=HUFFMAN_TABLE_BITS):
+	# Each entry is (symbol, bitlen) for codes that fit in the primary
+	# table, or (subtable, -subbits) for longer codes sharing a prefix
+	tablebits = min(tablebits, max(huffsym[1] for huffsym in huffsyms))
+	table = [None] * (1 << tablebits)
+
+	subtablebits = {}
+	for huffsym in huffsyms:
+		bitlen = huffsym[1]
+		if bitlen > tablebits:
+			prefix = huffsym[2] >> (bitlen - tablebits)
+			subtablebits[prefix] = max(subtablebits.get(prefix, 0),
+			                           bitlen - tablebits)
+	for prefix, subbits in subtablebits.items():
+		table[prefix] = ([None] * (1 << subbits), -subbits)
+
+	for huffsym in huffsyms:
+		symbol = huffsym[0]
+		bitlen = huffsym[1]
+		huffcode = huffsym[2]
+		if bitlen == 0:
+			continue
+
+		if bitlen <= tablebits:
+			subtable = table
+			subbits = tablebits
+		else:
+			bitlen -= tablebits
+			subtable, subbits = table[huffcode >> bitlen]
+			subbits = -subbits
+			huffcode &= (1 << bitlen) - 1
+
+		shift = subbits - bitlen
+		start = huffcode << shift
+		entry = (symbol, bitlen)
+		for idx in xrange(start, start + (1 << shift)):
+			subtable[idx] = entry
+	return (table, tablebits)
+
+
+
+def HuffmanTableDecode(hufftable, bits):
+	table, tablebits = hufftable
+	symbol, bitlen = table[bits.peek(tablebits)]
+	if bitlen < 0:
+		bits.skip(tablebits)
+		symbol, bitlen = symbol[bits.peek(-bitlen)]
+	bits.skip(bitlen)
+	return symbol
+
+
+
+def LoadCharLenHuffmanSyms(bits, extra_hufftree, decode=HuffmanDecode):
 	huffsyms = None
 	symscount = bits.read(9)
 
@@ -82,7 +142,7 @@ def LoadCharLenHuffmanSyms(bits, extra_hufftree):
 		huffsyms = []
 		idx = 0
 		while idx < symscount:
-			bitlen = HuffmanDecode(extra_hufftree, bits)
+			bitlen = decode(extra_hufftree, bits)
 			
 			if bitlen == 0:
 				bitlen = 0
@@ -111,38 +171,189 @@ def LoadCharLenHuffmanSyms(bits, extra_hufftree):
 	return huffsyms
 
 
-def Decompress(buf):
-	(compressed_size, decompressed_size) =  struct.unpack("<II", buf[0:8])
-	bits = BitArray.BitArray(buf[8:])
-
-	outbuf = ''
-	blocksize = 0
-	charlen_hufftree = None
-	positionset_hufftree = None
-	while decompressed_size:
-		if blocksize == 0:		
-			blocksize = bits.read(16)		
-			extra_hufftree = BuildHuffmanTree(LoadHuffmanSyms(bits, 5, 3))
-			charlen_hufftree = BuildHuffmanTree(LoadCharLenHuffmanSyms(bits, extra_hufftree))
-
-	#		positionset_hufftree = BuildHuffmanTree(LoadHuffmanSyms(bits, 4, -1))
-			positionset_hufftree = BuildHuffmanTree(LoadHuffmanSyms(bits, 5, -1))
-
-		c = HuffmanDecode(charlen_hufftree, bits)
-		blocksize -= 1
-		if c < 256:
-			outbuf += chr(c)
-			decompressed_size -= 1
+def CopyMatch(outbuf, outidx, data_idx, data_length):
+	# The source may overlap the bytes being written, in which case it
+	# repeats with a period of outidx - data_idx. Every slice copied
+	# doubles the available period, so runs need log(n) slice copies.
+	while data_length:
+		count = min(outidx - data_idx, data_length)
+		outbuf[outidx:outidx+count] = outbuf[data_idx:data_idx+count]
+		outidx += count
+		data_length -= count
+	return outidx
+
+
+class StreamDecompressor(object):
+
+	def __init__(self, tables=True, window=WINDOW_SIZE):
+		# Flat lookup tables decode a whole symbol per probe, the tree
+		# walker is kept around to check them against
+		if tables:
+			self._Build = BuildHuffmanTable
+			self._Decode = HuffmanTableDecode
 		else:
-			data_length = (c & 0xff) + 3
-			pos_bitlen = HuffmanDecode(positionset_hufftree, bits)
-			data_offset = pos_bitlen
-			if pos_bitlen > 1:
-				data_offset = (1 << (pos_bitlen - 1)) + bits.read(pos_bitlen - 1)
-			data_idx = len(outbuf) - data_offset -1
-
-			for i in xrange(0, data_length):
-				outbuf += outbuf[data_idx+i]
-			decompressed_size -= data_length
-
-	return outbuf
+			self._Build = BuildHuffmanTree
+			self._Decode = HuffmanDecode
+
+		# Only the last window bytes of output are kept for back-references
+		# when set, otherwise the whole output is preallocated up front
+		self._Window = window
+
+		self._Header = ''
+		self._Bits = None
+		self._InputLeft = 0
+		self._OutBuf = None
+		self._OutIdx = 0
+		self._OutLeft = 0
+		self._Emitted = 0
+
+		self._BlockSize = 0
+		self._CharLenTree = None
+		self._PositionSetTree = None
+		self._StepBits = 0
+
+		self.size = None
+		self.done = False
+
+	def _Begin(self, buf, offset, final=False):
+		(compressed_size, decompressed_size) = struct.unpack("<II", buf[offset-8:offset])
+		self.size = decompressed_size
+
+		available = len(buf) - offset
+		self._InputLeft = max(compressed_size - available, 0)
+		if final:
+			self._InputLeft = 0
+		self._Bits = BitArray.BitReader(buf, offset, self._InputLeft == 0)
+
+		outsize = decompressed_size
+		if self._Window is not None:
+			outsize = min(outsize, 2 * self._Window)
+		self._OutBuf = bytearray(outsize)
+		self._OutLeft = decompressed_size
+		self.done = decompressed_size == 0
+
+	def _LoadBlock(self, bits):
+		blocksize = bits.read(16)
+		extra_hufftree = self._Build(LoadHuffmanSyms(bits, 5, 3))
+		charlen_huffsyms = LoadCharLenHuffmanSyms(bits, extra_hufftree, self._Decode)
+	#	positionset_huffsyms = LoadHuffmanSyms(bits, 4, -1)
+		positionset_huffsyms = LoadHuffmanSyms(bits, 5, -1)
+
+		# Upper bound on the bits a single symbol can consume, so that the
+		# decode loop only needs to checkpoint near the end of the input
+		stepbits = max(huffsym[1] for huffsym in charlen_huffsyms)
+		stepbits += max(huffsym[1] for huffsym in positionset_huffsyms)
+		stepbits += max(huffsym[0] for huffsym in positionset_huffsyms)
+
+		return (blocksize, self._Build(charlen_huffsyms),
+		        self._Build(positionset_huffsyms), stepbits)
+
+	def _Slide(self, outidx, pieces):
+		# Hand out everything decoded so far, then drop all but the last
+		# window bytes and reclaim the space at the end of the buffer
+		outbuf = self._OutBuf
+		pieces.append(bytes(outbuf[self._Emitted:outidx]))
+		discard = outidx - self._Window
+		del outbuf[:discard]
+		outbuf.extend(bytearray(discard))
+		self._Emitted = self._Window
+		return self._Window
+
+	def _Run(self, pieces):
+		bits = self._Bits
+		decode = self._Decode
+		outbuf = self._OutBuf
+		outlen = len(outbuf)
+		outidx = self._OutIdx
+		outleft = self._OutLeft
+		blocksize = self._BlockSize
+		charlen_hufftree = self._CharLenTree
+		positionset_hufftree = self._PositionSetTree
+		stepbits = self._StepBits
+		final = bits.final
+		slidelimit = outlen - MAX_MATCH
+
+		while outleft:
+			if outidx > slidelimit and outidx + outleft > outlen:
+				outidx = self._Slide(outidx, pieces)
+
+			if blocksize == 0:
+				state = bits.save()
+				try:
+					(blocksize, charlen_hufftree, positionset_hufftree,
+					 stepbits) = self._LoadBlock(bits)
+				except BitArray.NeedMoreData:
+					bits.restore(state)
+					break
+
+			state = None
+			if not final and bits.available() < stepbits:
+				state = bits.save()
+			try:
+				c = decode(charlen_hufftree, bits)
+				if c >= 256:
+					pos_bitlen = decode(positionset_hufftree, bits)
+					data_offset = pos_bitlen
+					if pos_bitlen > 1:
+						data_offset = (1 << (pos_bitlen - 1)) + bits.read(pos_bitlen - 1)
+			except BitArray.NeedMoreData:
+				bits.restore(state)
+				break
+
+			blocksize -= 1
+			if c < 256:
+				outbuf[outidx] = c
+				outidx += 1
+				outleft -= 1
+			else:
+				data_length = (c & 0xff) + 3
+				data_idx = outidx - data_offset -1
+				if data_idx < 0:
+					raise ValueError("Match offset %d outside of output window"
+					                 % data_offset)
+
+				data_length = min(data_length, outleft)
+				outidx = CopyMatch(outbuf, outidx, data_idx, data_length)
+				outleft -= data_length
+
+		self._OutIdx = outidx
+		self._OutLeft = outleft
+		self._BlockSize = blocksize
+		self._CharLenTree = charlen_hufftree
+		self._PositionSetTree = positionset_hufftree
+		self._StepBits = stepbits
+		self.done = outleft == 0
+
+	def feed(self, data):
+		""" Decompress another chunk of input, returning whatever output
+		    it completes. Input past the compressed size in the header is
+		    ignored. """
+		if self._Bits is None:
+			self._Header += data
+			if len(self._Header) < 8:
+				return ''
+			self._Begin(bytearray(self._Header), 8)
+		elif self._InputLeft:
+			data = data[:self._InputLeft]
+			self._InputLeft -= len(data)
+			self._Bits.extend(data, self._InputLeft == 0)
+
+		pieces = []
+		self._Run(pieces)
+		pieces.append(bytes(self._OutBuf[self._Emitted:self._OutIdx]))
+		self._Emitted = self._OutIdx
+		return ''.join(pieces)
+
+	def close(self):
+		if not self.done:
+			raise ValueError("Compressed stream truncated")
+
+
+def Decompress(buf, tables=True, as_memoryview=False):
+	decompressor = StreamDecompressor(tables, window=None)
+	decompressor._Begin(buf, 8, final=True)
+	decompressor._Run(None)
+
+	if as_memoryview:
+		return memoryview(decompressor._OutBuf)
+	return bytes(decompressor._OutBuf)
@@ -2,6 +2,10 @@
 
 import EfiCompressor
 import firmware_config.ibm.EfiDecompressor
+import copy
+import hashlib
+import json
+import os
 import struct
 import time
 import random
@@ -11,6 +15,7 @@ from pyghmi.ipmi import command
 
 from firmware_config import FirmwareConfig
 from firmware_config import exceptions as exc
+from firmware_config import retry
 
 IMM_NETFN = 0x2e
 IMM_COMMAND = 0x90
@@ -23,150 +28,491 @@ WRITE_COMMAND = [0x03]
 CLOSE_COMMAND = [0x05]
 SIZE_COMMAND = [0x06]
 
+# Transfer block sizes, in bytes of file data per IPMI request. Larger
+# sizes are probed on the first read from each host and the largest one
+# the IMM accepts is remembered in BLOCKSIZES.
+DEFAULT_BLOCKSIZE = 0xc8
+BLOCKSIZE_CANDIDATES = [0x3c0, 0x1e0, 0xf0]
+BLOCKSIZES = {}
+# Writes are limited separately, since the IMM may accept larger reads
+WRITE_BLOCKSIZES = {}
+# The completion code pyghmi reports when the IMM never answered
+TIMEOUT_CODE = 0xffff
+
+# Parsed options from the last config.efi read from each host, keyed by
+# host and holding the file size, a digest of the compressed file and the
+# options dict
+CACHE = {}
+
+# A session idle for longer than this is checked with a Get Device ID
+# before reuse, rather than trusted blindly or replaced with a new login
+SESSION_IDLE = 20
+
+# Number of times a single block is re-requested before the transfer is
+# abandoned, and how many times a dropped transfer is reopened and resumed
+# from the last good offset
+BLOCK_RETRIES = 3
+RESUME_RETRIES = 3
+
+# Completion code the IMM answers a size request for a missing file with
+FILE_NOT_FOUND = 0xcb
+
+# How long set_fw_options waits for the IMM to apply asu_update.efi
+COMMIT_TIMEOUT = 120
+
+
+class BlockPacket(object):
+    def __init__(self, command, filehandle, size):
+        # The enterprise number, command and file handle are the same for
+        # every block of a transfer, so build them once and only fill in
+        # the offset and the size or payload for each request
+        self.buf = bytearray(IBM_ENTERPRISE + command)
+        self.buf += struct.pack("<I", filehandle)
+        self.buf += bytearray(4 + size)
+
+    def read(self, offset, amount):
+        struct.pack_into("<IH", self.buf, 8, offset, amount)
+        return self.buf
+
+    def write(self, offset, inputdata):
+        struct.pack_into("<I", self.buf, 8, offset)
+        end = 12 + len(inputdata)
+        self.buf[12:end] = inputdata
+        if end == len(self.buf):
+            return self.buf
+        return self.buf[:end]
+
 
 class IBMFirmwareConfig(FirmwareConfig):
-    def __init__(self, host, user, password):
+    def __init__(self, host, user, password, blocksize=None, cache_dir=None,
+                 trust_size=False, retry_policy=None,
+                 commit_timeout=COMMIT_TIMEOUT):
         self.connection = None
+        self.last_used = 0
+        self.session_stats = dict(handshakes=0, reused=0, probes=0)
+        # Sizes of the last update written by set_fw_options
+        self.update_stats = dict(xml=0, compressed=0)
+        self.blocksize = blocksize
+        # Set when an oversized read or write took the session down, so
+        # that the resumed transfer doesn't try the same size again
+        self.read_blocksize = None
+        self.write_blocksize = None
+        self.cache_dir = cache_dir
+        self.trust_size = trust_size
+        if retry_policy is None:
+            retry_policy = retry.RetryPolicy()
+        self.retry_policy = retry_policy
+        self.commit_timeout = commit_timeout
         super(IBMFirmwareConfig, self).__init__(host, user, password)
 
-    def imm_connect(self, host, username, password):
+    def imm_session(self, host, username, password):
         try:
             connection = command.Command(bmc=host, userid=username,
-                                         password=password)
+                                         password=password, keepalive=True)
         except pyghmi.exceptions.IpmiException:
             raise exc.AuthException
 
         assert connection is not None
-        self.connection = connection
+        return connection
 
-    def imm_size(self, filename):
-        data = []
-        data += IBM_ENTERPRISE
-        data += SIZE_COMMAND
-        for i in range(len(filename)):
-            data += [ord(filename[i])]
+    def imm_session_alive(self):
+        session = self.connection.ipmi_session
+        if session.broken or not session.logged:
+            return False
 
-        response = self.connection.raw_command(netfn=IMM_NETFN,
-                                               command=IMM_COMMAND, data=data)
+        if time.time() - self.last_used < SESSION_IDLE:
+            return True
+
+        # pyghmi only sends keepalives while something is waiting on it,
+        # so make sure an idle session is still there
+        self.session_stats['probes'] += 1
+        try:
+            response = self.connection.raw_command(netfn=0x06, command=0x01)
+        except pyghmi.exceptions.IpmiException:
+            return False
+        return response.get('code', 0) == 0
+
+    def imm_connect(self, host, username, password):
+        # Only pay for a new RMCP+ session when the old one has expired
+        if self.connection is not None and self.imm_session_alive():
+            self.session_stats['reused'] += 1
+        else:
+            self.connection = self.imm_session(host, username, password)
+            self.session_stats['handshakes'] += 1
+        self.last_used = time.time()
 
-        size = ''.join(chr(c) for c in response['data'][3:7])
+    def close(self):
+        if self.connection is not None:
+            self.connection.ipmi_session.logout()
+            self.connection = None
 
-        size = struct.unpack("i", size)
-        return size[0]
+    def imm_file_size(self, filename):
+        data = bytearray(IBM_ENTERPRISE + SIZE_COMMAND)
+        data += filename
+
+        response = self.connection.raw_command(netfn=IMM_NETFN,
+                                               command=IMM_COMMAND, data=data)
 
-    def imm_open(self, filename, write=False, size=None):
-        response = None
-        retries = 6
-        data = []
-        data += IBM_ENTERPRISE
+        code = response.get('code', 0)
+        if code != 0:
+            return (code, None)
+
+        size = struct.unpack_from("<i", bytearray(response['data']), 3)
+        return (0, size[0])
+
+    def imm_size(self, filename, deadline=None):
+        for attempt in self.retry_policy.attempts(deadline):
+            if attempt:
+                self.imm_connect(self.host, self.user, self.password)
+            (code, size) = self.imm_file_size(filename)
+            if code == 0:
+                return size
+            # A file the IMM can't find is reported as empty
+            if code == FILE_NOT_FOUND:
+                return 0
+            if not self.retry_policy.retryable(code):
+                raise exc.TransferException(
+                    "Unable to get the size of %s: completion code 0x%x" %
+                    (filename, code), retryable=False)
+
+        raise exc.TransferException("Timed out getting the size of %s" %
+                                    filename, retryable=False)
+
+    def imm_open(self, filename, write=False, size=None, deadline=None):
+        data = bytearray(IBM_ENTERPRISE)
         if write is False:
-            data += OPEN_RO_COMMAND
+            data += bytearray(OPEN_RO_COMMAND)
         else:
             assert size is not None
-            data += OPEN_WO_COMMAND
-            hex_size = struct.pack("<I", size)
-            for byte in hex_size[:4]:
-                data += [ord(byte)]
-            data += [0x01, 0x10]
-        for i in range(len(filename)):
-            data += [ord(filename[i])]
-        while len(data) < 38:
-            data += [0x00]
-
-        while retries:
-            retries = retries-1
+            data += bytearray(OPEN_WO_COMMAND)
+            data += struct.pack("<I", size)
+            data += bytearray([0x01, 0x10])
+        data += filename
+        if len(data) < 38:
+            data += bytearray(38 - len(data))
+
+        for attempt in self.retry_policy.attempts(deadline):
+            if attempt:
+                # Make sure that the connection hasn't timed out
+                self.imm_connect(self.host, self.user, self.password)
             response = self.connection.raw_command(netfn=IMM_NETFN,
                                                    command=IMM_COMMAND,
                                                    data=data)
-            try:
-                if response['code'] == 0 or retries == 0:
-                    break
-            except KeyError:
-                pass
-
-            time.sleep(10)
-            # Make sure that the connection hasn't timed out
-            self.imm_connect(self.host, self.user, self.password)
-
-        filehandle = ''.join(chr(byte) for byte in response['data'][3:7])
+            code = response.get('code', 0)
+            if code == 0:
+                break
+            if not self.retry_policy.retryable(code):
+                raise exc.TransferException(
+                    "Unable to open %s: completion code 0x%x" %
+                    (filename, code), retryable=False)
+        else:
+            # The whole operation is out of time, so there's no point in
+            # the callers reopening it
+            raise exc.TransferException("Timed out opening %s" % filename,
+                                        retryable=False)
 
-        filehandle = struct.unpack("<I", filehandle)[0]
+        filehandle = struct.unpack_from("<I", bytearray(response['data']), 3)[0]
         return filehandle
 
     def imm_close(self, filehandle):
-        data = []
-        data += IBM_ENTERPRISE
-        data += CLOSE_COMMAND
-
-        hex_filehandle = struct.pack("<I", filehandle)
-
-        for byte in hex_filehandle[:4]:
-            data += [ord(byte)]
+        data = bytearray(IBM_ENTERPRISE + CLOSE_COMMAND)
+        data += struct.pack("<I", filehandle)
 
         response = self.connection.raw_command(netfn=IMM_NETFN,
                                                command=IMM_COMMAND, data=data)
 
+    def imm_write_block(self, packet, offset, inputdata):
+        data = packet.write(offset, inputdata)
+
+        return self.connection.raw_command(netfn=IMM_NETFN,
+                                           command=IMM_COMMAND, data=data)
+
+    def imm_write_blocksize(self):
+        if self.write_blocksize is not None:
+            return self.write_blocksize
+        if self.blocksize is not None:
+            return self.blocksize
+        if self.host in WRITE_BLOCKSIZES:
+            return WRITE_BLOCKSIZES[self.host]
+        return BLOCKSIZES.get(self.host) or DEFAULT_BLOCKSIZE
+
     def imm_write(self, filehandle, size, inputdata):
-        blocksize = 0xc8
+        blocksize = self.imm_write_blocksize()
         offset = 0
-        remaining = size
-
-        hex_filehandle = struct.pack("<I", filehandle)
-
-        while remaining > 0:
-            data = []
-            data += IBM_ENTERPRISE
-            data += WRITE_COMMAND
-            for byte in hex_filehandle[:4]:
-                data += [ord(byte)]
-            hex_offset = struct.pack("<I", offset)
-            for byte in hex_offset[:4]:
-                data += [ord(byte)]
-            if remaining < blocksize:
-                amount = remaining
-            else:
-                amount = blocksize
-            for byte in inputdata[offset:offset+amount]:
-                data += [ord(byte)]
-            remaining -= blocksize
-            offset += blocksize
+        failures = 0
+        packet = BlockPacket(WRITE_COMMAND, filehandle, blocksize)
+        inputdata = memoryview(inputdata)
+
+        while offset < size:
+            amount = min(blocksize, size - offset)
+            # The first block is the probe for an untried write size
+            probe = amount > DEFAULT_BLOCKSIZE and offset == 0
+            try:
+                response = self.imm_write_block(packet, offset,
+                                                inputdata[offset:offset+amount])
+            except pyghmi.exceptions.IpmiException:
+                # Some IMMs drop oversized writes rather than rejecting
+                # them. The session may not have survived, so let the
+                # caller start again at the default size.
+                if probe:
+                    self.write_blocksize = DEFAULT_BLOCKSIZE
+                raise
+            if probe and response.get('code', 0) == TIMEOUT_CODE:
+                self.write_blocksize = DEFAULT_BLOCKSIZE
+                raise pyghmi.exceptions.IpmiException(
+                    "Write of %d bytes timed out" % amount)
+            if response.get('code', 0) == 0:
+                if probe and amount == blocksize:
+                    WRITE_BLOCKSIZES[self.host] = blocksize
+                offset += amount
+                failures = 0
+                continue
 
-            response = self.connection.raw_command(netfn=IMM_NETFN,
-                                                   command=IMM_COMMAND,
-                                                   data=data)
+            # The IMM may accept larger reads than writes, so drop back to
+            # the default size if it rejects the first oversized block
+            if probe:
+                WRITE_BLOCKSIZES[self.host] = DEFAULT_BLOCKSIZE
+                blocksize = DEFAULT_BLOCKSIZE
+                continue
+
+            # Otherwise just send the rejected block again
+            failures += 1
+            if failures > BLOCK_RETRIES:
+                raise exc.TransferException(
+                    "Failed to write %d bytes at offset %d" % (amount, offset))
+
+    def imm_write_file(self, filename, inputdata, deadline=None):
+        attempts = 0
+        while True:
+            try:
+                self.imm_connect(self.host, self.user, self.password)
+                filehandle = self.imm_open(filename, write=True,
+                                           size=len(inputdata),
+                                           deadline=deadline)
+                self.imm_write(filehandle, len(inputdata), inputdata)
+                self.imm_close(filehandle)
+                return
+            except pyghmi.exceptions.IpmiException:
+                # The session dropped and took the handle with it. Reopening
+                # a file for writing starts it afresh, so start again from
+                # the beginning on a (possibly new) session.
+                attempts += 1
+                if attempts > RESUME_RETRIES:
+                    raise
+                if deadline is not None and deadline.expired():
+                    raise
+                self.last_used = 0
+
+    def imm_read_block(self, packet, offset, amount):
+        data = packet.read(offset, amount)
+
+        return self.connection.raw_command(netfn=IMM_NETFN,
+                                           command=IMM_COMMAND, data=data)
+
+    def imm_blocksize(self):
+        if self.blocksize is not None:
+            return self.blocksize
+        if self.read_blocksize is not None:
+            return self.read_blocksize
+        return BLOCKSIZES.get(self.host)
+
+    def imm_probe_read(self, filehandle, size, offset):
+        # Try the candidate sizes largest first on the next block of the
+        # file, so the probe costs no extra round trips once it succeeds
+        tried = None
+        packet = BlockPacket(READ_COMMAND, filehandle, 2)
+        for blocksize in BLOCKSIZE_CANDIDATES:
+            amount = min(blocksize, size - offset)
+            if amount == tried:
+                continue
+            tried = amount
+            try:
+                response = self.imm_read_block(packet, offset, amount)
+                code = response.get('code', 0)
+            except pyghmi.exceptions.IpmiException:
+                code = TIMEOUT_CODE
+            if code == TIMEOUT_CODE:
+                # Some IMMs drop oversized reads rather than rejecting them,
+                # which takes the session with them. Have the resumed
+                # transfer use the default size instead of probing again.
+                # This may have been a transient failure, so it is only
+                # remembered for this instance.
+                self.read_blocksize = DEFAULT_BLOCKSIZE
+                raise pyghmi.exceptions.IpmiException(
+                    "Read of %d bytes timed out" % amount)
+            if code != 0:
+                continue
+            if len(response['data']) - 5 != amount:
+                continue
+
+            # A file smaller than the block proves nothing about the limit
+            if amount == blocksize:
+                BLOCKSIZES[self.host] = blocksize
+            return (response, blocksize)
+
+        # The IMM itself turned every larger size down
+        BLOCKSIZES[self.host] = DEFAULT_BLOCKSIZE
+        return (None, DEFAULT_BLOCKSIZE)
+
+    def imm_read_checked(self, packet, offset, amount, deadline=None):
+        # Only the block that failed or came back short is asked for again
+        for attempt in self.retry_policy.attempts(deadline):
+            response = self.imm_read_block(packet, offset, amount)
+            code = response.get('code', 0)
+            if code == 0 and len(response.get('data', [])) - 5 == amount:
+                return bytearray(response['data'][5:])
+            if not self.retry_policy.retryable(code):
+                raise exc.TransferException(
+                    "Unable to read at offset %d: completion code 0x%x" %
+                    (offset, code), retryable=False)
+            if attempt == BLOCK_RETRIES:
+                break
+
+        raise exc.TransferException("Failed to read %d bytes at offset %d" %
+                                    (amount, offset))
+
+    def imm_read_blocks(self, filehandle, size, offset=0, deadline=None):
+        blocksize = self.imm_blocksize()
+
+        if blocksize is None and size - offset > DEFAULT_BLOCKSIZE:
+            (response, blocksize) = self.imm_probe_read(filehandle, size,
+                                                        offset)
+            if response is not None:
+                offset += len(response['data']) - 5
+                yield bytearray(response['data'][5:])
+        elif blocksize is None:
+            blocksize = DEFAULT_BLOCKSIZE
+
+        packet = BlockPacket(READ_COMMAND, filehandle, 2)
+        while offset < size:
+            amount = min(blocksize, size - offset)
+            data = self.imm_read_checked(packet, offset, amount, deadline)
+            offset += amount
+
+            yield data
+
+    def imm_read_file(self, filename, deadline=None):
+        offset = 0
+        attempts = 0
+        filesize = None
+        while True:
+            filehandle = None
+            try:
+                self.imm_connect(self.host, self.user, self.password)
+                filehandle = self.imm_open(filename, deadline=deadline)
+                size = self.imm_size(filename, deadline)
+                if filesize is None:
+                    filesize = size
+                elif size != filesize:
+                    # The blocks already read belong to the old file, so
+                    # only a read from the start can help
+                    raise exc.TransferException(
+                        "%s changed size during read" % filename,
+                        resumable=False)
+
+                for data in self.imm_read_blocks(filehandle, size, offset,
+                                                 deadline):
+                    offset += len(data)
+                    if deadline is not None:
+                        deadline.reset()
+                    yield data
+                self.imm_close(filehandle)
+                return
+            except (pyghmi.exceptions.IpmiException,
+                    exc.TransferException) as e:
+                # Don't leave the old handle open on the IMM, if the
+                # session it was opened on is still there
+                if filehandle is not None:
+                    try:
+                        self.imm_close(filehandle)
+                    except pyghmi.exceptions.IpmiException:
+                        pass
+                if not getattr(e, 'retryable', True) or \
+                   not getattr(e, 'resumable', True):
+                    raise
+                # Reopen the file, on a new session if the old one has
+                # gone, and carry on from the last block that arrived intact
+                attempts += 1
+                if attempts > RESUME_RETRIES:
+                    raise
+                if deadline is not None and deadline.expired():
+                    raise
+                self.last_used = 0
 
     def imm_read(self, filehandle, size):
-        blocksize = 0xc8
+        output = bytearray(size)
         offset = 0
-        output = []
-        remaining = size
-
-        hex_filehandle = struct.pack("<I", filehandle)
-        hex_blocksize = struct.pack("<H", blocksize)
-
-        while remaining > 0:
-            data = []
-            data += IBM_ENTERPRISE
-            data += READ_COMMAND
-            for byte in hex_filehandle[:4]:
-                data += [ord(byte)]
-            hex_offset = struct.pack("<I", offset)
-            for byte in hex_offset[:4]:
-                data += [ord(byte)]
-            if remaining < blocksize:
-                hex_blocksize = struct.pack("<H", remaining)
-            for byte in hex_blocksize[:2]:
-                data += [ord(byte)]
-            remaining -= blocksize
-            offset += blocksize
+        for data in self.imm_read_blocks(filehandle, size):
+            output[offset:offset+len(data)] = data
+            offset += len(data)
+        return output
 
-            response = self.connection.raw_command(netfn=IMM_NETFN,
-                                                   command=IMM_COMMAND,
-                                                   data=data)
+    def cache_path(self):
+        return os.path.join(self.cache_dir, "%s.json" % self.host)
 
-            output += response['data'][5:]
+    def cache_get(self, size):
+        entry = CACHE.get(self.host)
+        if entry is None and self.cache_dir is not None:
+            try:
+                with open(self.cache_path()) as cachefile:
+                    entry = json.load(cachefile)
+            except (IOError, ValueError):
+                return None
+            CACHE[self.host] = entry
+
+        if entry is None or entry['size'] != size:
+            return None
+        return entry
+
+    def cache_put(self, size, digest, options):
+        entry = dict(size=size, digest=digest, options=copy.deepcopy(options))
+        CACHE[self.host] = entry
+        if self.cache_dir is None:
+            return
 
-        return ''.join(chr(c) for c in output)
+        # Write a new file and rename it over the old one so that a
+        # concurrent reader never sees a partial entry
+        path = self.cache_path()
+        with open(path + ".tmp", "w") as cachefile:
+            json.dump(entry, cachefile)
+        os.rename(path + ".tmp", path)
+
+    def cache_invalidate(self):
+        CACHE.pop(self.host, None)
+        if self.cache_dir is None:
+            return
+        try:
+            os.unlink(self.cache_path())
+        except OSError:
+            pass
+
+    def imm_wait_for_commit(self, config_size, timeout):
+        # The IMM consumes asu_update.efi once it has applied it and then
+        # regenerates config.efi, so poll the sizes of the two files rather
+        # than fetching the configuration again. Start polling quickly and
+        # back off, since small updates are usually applied within seconds.
+        # A busy IMM just means another poll, and only a file it reports
+        # missing or empty counts as consumed.
+        policy = retry.RetryPolicy(initial=0.25, maximum=5, deadline=timeout)
+        for attempt in policy.attempts():
+            # The update has only just been closed, so give the IMM the
+            # first interval before looking
+            if not attempt:
+                continue
+            self.imm_connect(self.host, self.user, self.password)
+            (code, size) = self.imm_file_size("asu_update.efi")
+            if code == FILE_NOT_FOUND or (code == 0 and size == 0):
+                return True
+            if code != 0:
+                if not self.retry_policy.retryable(code):
+                    raise exc.TransferException(
+                        "Unable to check asu_update.efi: completion code 0x%x"
+                        % code, retryable=False)
+                continue
+            (code, size) = self.imm_file_size("config.efi")
+            if code == 0 and size != config_size:
+                return True
+        return False
 
     def factory_reset(self):
         options = self.get_fw_options()
@@ -177,64 +523,111 @@ class IBMFirmwareConfig(FirmwareConfig):
                 options[option]['new_value'] = options[option]['default']
         self.set_fw_options(options)
 
+    def parse_settings(self, parser, options):
+        # Build option records from each setting as soon as the parser has
+        # seen all of it, then throw the element away so that only the
+        # config and group elements above it stay in memory
+        for event, setting in parser.read_events():
+            is_list = False
+            group = setting.getparent()
+            ibm_group = group.get("ID")
+            ibm_id = group.getparent().get("ID")
+            ibm_setting = setting.get("ID")
+            possible = []
+            current = None
+            default = None
+            reset = False
+            name = setting.find("mriName").text
+
+            if setting.find("list_data") is not None:
+                is_list = True
+                current = []
+
+            for choice in setting.iter("choice"):
+                label = choice.find("label").text
+                possible.append(label)
+                instance = choice.find("instance")
+                if instance is not None:
+                    if is_list:
+                        current.append(label)
+                    else:
+                        current = label
+                if choice.get("default") == "true":
+                    default = label
+                if choice.get("reset-required") == "true":
+                    reset = True
+            optionname = "%s.%s" % (ibm_id, name)
+            options[optionname] = dict(current=current,
+                                       default=default,
+                                       possible=possible,
+                                       pending=None,
+                                       new_value=None,
+                                       is_list=is_list,
+                                       ibm_id=ibm_id,
+                                       ibm_group=ibm_group,
+                                       ibm_setting=ibm_setting,
+                                       ibm_reboot=reset,
+                                       ibm_instance="")
+
+            setting.clear()
+            while setting.getprevious() is not None:
+                del group[0]
+
     def get_fw_options(self):
-        options = {}
-        for i in range(0, 10):
-            self.imm_connect(self.host, self.user, self.password)
-            filehandle = self.imm_open("config.efi")
-            size = self.imm_size("config.efi")
-            data = self.imm_read(filehandle, size)
-            self.imm_close(filehandle)
-            data = EfiDecompressor.Decompress(data)
-            if len(data) != 0:
+        # Every retry below, down to reopening the file, shares one deadline,
+        # which starts again each time a block arrives intact
+        deadline = self.retry_policy.start()
+        self.imm_connect(self.host, self.user, self.password)
+        size = self.imm_size("config.efi", deadline)
+        cached = self.cache_get(size)
+        if cached is not None and self.trust_size:
+            return copy.deepcopy(cached['options'])
+
+        for attempt in self.retry_policy.attempts(deadline):
+            # Decompress and parse each block as it arrives rather than
+            # holding the compressed, decompressed and parsed copies at once
+            decompressor = EfiDecompressor.StreamDecompressor()
+            parser = etree.XMLPullParser(events=("end",), tag="setting")
+            options = {}
+            digest = hashlib.sha1()
+            blocks = []
+            try:
+                for block in self.imm_read_file("config.efi", deadline):
+                    digest.update(block)
+                    # If we may already have this file, hold off on the
+                    # decompression until we know whether it has changed
+                    if cached is not None:
+                        blocks.append(block)
+                        continue
+                    data = decompressor.feed(block)
+                    if data:
+                        parser.feed(data)
+                        self.parse_settings(parser, options)
+            except exc.TransferException as e:
+                if not e.retryable:
+                    raise
+                continue
+
+            if cached is not None:
+                if digest.hexdigest() == cached['digest']:
+                    return copy.deepcopy(cached['options'])
+                cached = None
+                for block in blocks:
+                    data = decompressor.feed(block)
+                    if data:
+                        parser.feed(data)
+                        self.parse_settings(parser, options)
+
+            if decompressor.done and decompressor.size:
                 break;
+        else:
+            raise exc.TransferException("Unable to read config.efi from %s" %
+                                        self.host)
+
+        parser.close()
+        self.parse_settings(parser, options)
 
-            time.sleep(10)
-
-        xml = etree.fromstring(data)
-
-        for config in xml.iter("config"):
-            ibm_id = config.get("ID")
-            for group in config.iter("group"):
-                ibm_group = group.get("ID")
-                for setting in group.iter("setting"):
-                    is_list = False
-                    ibm_setting = setting.get("ID")
-                    possible = []
-                    current = None
-                    default = None
-                    reset = False
-                    name = setting.find("mriName").text
-
-                    if setting.find("list_data") is not None:
-                        is_list = True
-                        current = []
-
-                    for choice in setting.iter("choice"):
-                        label = choice.find("label").text
-                        possible.append(label)
-                        instance = choice.find("instance")
-                        if instance is not None:
-                            if is_list:
-                                current.append(label)
-                            else:
-                                current = label
-                        if choice.get("default") == "true":
-                            default = label
-                        if choice.get("reset-required") == "true":
-                            reset = True
-                    optionname = "%s.%s" % (ibm_id, name)
-                    options[optionname] = dict(current=current,
-                                               default=default,
-                                               possible=possible,
-                                               pending=None,
-                                               new_value=None,
-                                               is_list=is_list,
-                                               ibm_id=ibm_id,
-                                               ibm_group=ibm_group,
-                                               ibm_setting=ibm_setting,
-                                               ibm_reboot=reset,
-                                               ibm_instance="")
+        self.cache_put(size, digest.hexdigest(), options)
 
         return options
 
@@ -248,6 +641,10 @@ class IBMFirmwareConfig(FirmwareConfig):
 
         configurations = etree.Element('configurations', ID=ident,
                                        type='update', update='ASU Client')
+        # Settings sharing a config and group are written under a single
+        # pair of elements rather than one pair each
+        configs = {}
+        groups = {}
 
         for option in options.keys():
             if options[option]['new_value'] is None:
@@ -262,10 +659,16 @@ class IBMFirmwareConfig(FirmwareConfig):
             is_list = options[option]['is_list']
             count = 0
             changes = True
-            config = etree.Element('config', ID=options[option]['ibm_id'])
-            configurations.append(config)
-            group = etree.Element('group', ID=options[option]['ibm_group'])
-            config.append(group)
+            ibm_id = options[option]['ibm_id']
+            ibm_group = options[option]['ibm_group']
+            config = configs.get(ibm_id)
+            if config is None:
+                config = etree.SubElement(configurations, 'config', ID=ibm_id)
+                configs[ibm_id] = config
+            group = groups.get((ibm_id, ibm_group))
+            if group is None:
+                group = etree.SubElement(config, 'group', ID=ibm_group)
+                groups[(ibm_id, ibm_group)] = group
             setting = etree.Element('setting',
                                     ID=options[option]['ibm_setting'])
             group.append(setting)
@@ -299,20 +702,24 @@ class IBMFirmwareConfig(FirmwareConfig):
         if not changes:
             return
 
-        xml = etree.tostring(configurations)
+        xml = etree.tostring(configurations, pretty_print=False)
         data = EfiCompressor.FrameworkCompress(xml, len(xml))
+        self.update_stats = dict(xml=len(xml), compressed=len(data))
         self.imm_connect(self.host, self.user, self.password)
-        filehandle = self.imm_open("asu_update.efi", write=True,
-                                   size=len(data))
-        self.imm_write(filehandle, len(data), data)
-        self.imm_close(filehandle)
-
-        # FIXME - wait for commit
+        deadline = self.retry_policy.start()
+        config_size = self.imm_size("config.efi", deadline)
+        self.imm_write_file("asu_update.efi", data, deadline)
+        self.cache_invalidate()
 
         if reboot is True:
             self.reboot_required = True
 
+        if self.commit_timeout:
+            return self.imm_wait_for_commit(config_size, self.commit_timeout)
+        return True
+
     def reboot_system(self, options):
+        self.imm_connect(self.host, self.user, self.password)
         state = self.connection.get_power()
         if state['powerstate'] == 'on':
             self.connection.set_power("reset")
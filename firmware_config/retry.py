@@ -0,0 +1,63 @@
+import random
+import time
+
+# IPMI completion codes that will not change by asking again: invalid or
+# unsupported command, bad request length or data, missing sensor/record,
+# insufficient privilege. Anything else, including OEM and command
+# specific codes, is treated as the BMC being busy.
+FATAL_CODES = frozenset([0xc1, 0xc2, 0xc7, 0xc8, 0xc9, 0xcb, 0xcc, 0xcd,
+                         0xd4, 0xd6])
+
+
+class Deadline(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.reset()
+
+    def reset(self):
+        # Called whenever the operation makes progress, so that only time
+        # spent failing counts against it
+        self.expires = time.time() + self.seconds
+
+    def expired(self):
+        return time.time() >= self.expires
+
+
+class RetryPolicy(object):
+    def __init__(self, initial=0.5, multiplier=2, maximum=10, jitter=0.25,
+                 deadline=60, fatal_codes=FATAL_CODES):
+        self.initial = initial
+        self.multiplier = multiplier
+        self.maximum = maximum
+        self.jitter = jitter
+        self.deadline = deadline
+        self.fatal_codes = fatal_codes
+
+    def retryable(self, code):
+        return code not in self.fatal_codes
+
+    def start(self):
+        return Deadline(self.deadline)
+
+    def attempts(self, deadline=None):
+        """ Yields the attempt number before each try, sleeping with
+            exponential backoff in between. Stops once the next try would
+            start after the deadline, so callers should treat running off
+            the end of the loop as a failure. Pass the Deadline from
+            start() to share one budget between nested retries. """
+        if deadline is None:
+            deadline = self.start()
+        delay = self.initial
+        attempt = 0
+        while True:
+            yield attempt
+            attempt += 1
+
+            remaining = deadline.expires - time.time()
+            if remaining <= 0:
+                return
+
+            # Spread out retries from many callers hitting the same BMC
+            sleep = delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            time.sleep(min(sleep, remaining))
+            delay = min(delay * self.multiplier, self.maximum)